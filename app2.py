@@ -1,28 +1,67 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import pandas as pd
+import numpy as np
 import folium
-from streamlit_folium import st_folium
-from folium.plugins import HeatMap
-from geopy.distance import geodesic
+from folium.plugins import HeatMap, FastMarkerCluster
+from pyproj import Geod
 import io
 import os
 import time
 import json
-import google.generativeai as genai
+import random
+import hashlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 from PIL import Image
-import re
 
 # ==========================================
 # --- 0. AI NEURAL ENGINE (BACKEND CORE) ---
 # ==========================================
 
-def get_ai_response(image_input):
+# Gemini calls are network-bound, so fan them out instead of sleeping between them.
+MAX_CONCURRENT_REQUESTS = 8  # keep under the free-tier RPM quota
+MAX_RETRIES = 4
+
+class ExtractionError(Exception):
+    """Raised (never returned) on failure so st.cache_data only ever
+    memoizes successful extractions — a transient error must not be
+    replayed from cache on the next identical upload."""
+
+PROMPT = """
+Analyze this image for location clues (architecture, signs, vegetation, weather).
+
+TASK:
+1. Identify the specific landmark if possible.
+2. If unknown, ESTIMATE the location (City/Region) based on visual evidence.
+3. You MUST return coordinates, e.g. name "Eiffel Tower (Estimated)".
+"""
+
+# JSON mode: the model is forced to emit this shape, so no regex cleanup needed
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "lat": {"type": "number"},
+        "lng": {"type": "number"},
+        "name": {"type": "string"}
+    },
+    "required": ["lat", "lng", "name"]
+}
+
+@st.cache_resource(show_spinner=False)
+def resolve_model():
     """
     Auto-detects the correct model for your API Key.
+    Cached for the process lifetime; raises so failures are never cached.
     """
+    # Deferred import: genai drags in grpc/protobuf, which would otherwise
+    # tax first paint and every rerun that never touches the AI at all.
+    import google.generativeai as genai
+
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
-        return None, "❌ Cloud Security Error: API Key Missing."
+        raise RuntimeError("❌ Cloud Security Error: API Key Missing.")
 
     genai.configure(api_key=api_key)
 
@@ -38,108 +77,176 @@ def get_ai_response(image_input):
                     chosen_model = m.name
                     break # Found a good one!
     except Exception as e:
-        return None, f"❌ API Connection Error: {e}"
+        raise RuntimeError(f"❌ API Connection Error: {e}")
 
     # Fallback if auto-discovery fails
     if not chosen_model:
         chosen_model = 'gemini-pro'
 
-    # ---------------------------------------------------------
-    # 🧠 EXECUTE ANALYSIS
-    # ---------------------------------------------------------
+    return genai.GenerativeModel(chosen_model)
+
+def get_ai_response(model, image_input):
+    """
+    Runs one analysis call, backing off only when the quota actually pushes back.
+    """
+    from google.api_core import exceptions as google_exceptions
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            response = model.generate_content(
+                [PROMPT, image_input],
+                generation_config={
+                    "response_mime_type": "application/json",
+                    "response_schema": RESPONSE_SCHEMA
+                }
+            )
+            return response.text, None
+        except google_exceptions.ResourceExhausted:
+            if attempt == MAX_RETRIES - 1:
+                return None, "🚨 Rate limit exceeded after retries."
+            time.sleep(2 ** attempt + random.random())
+        except Exception as e:
+            return None, f"🚨 Model call failed: {str(e)}"
+
+MAX_UPLOAD_EDGE = 1024  # Gemini rescales internally anyway; don't ship 4000px originals
+
+def _shrink_for_upload(img):
+    """Downscale + JPEG-recompress so the network upload isn't the bottleneck."""
+    if max(img.size) <= MAX_UPLOAD_EDGE:
+        return img
+    img.thumbnail((MAX_UPLOAD_EDGE, MAX_UPLOAD_EDGE), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+    buf.seek(0)
+    return Image.open(buf)
+
+def _analyze_file(model, file):
+    """Worker: one image in, one (name, lat, lng, landmark) row (or error string) out."""
     try:
-        model = genai.GenerativeModel(chosen_model)
-        
-        prompt = """
-        Analyze this image for location clues (architecture, signs, vegetation, weather).
-        
-        TASK:
-        1. Identify the specific landmark if possible.
-        2. If unknown, ESTIMATE the location (City/Region) based on visual evidence.
-        3. You MUST return a JSON object with coordinates.
-        
-        Format exactly like this (Raw JSON only): 
-        {"lat": 48.8584, "lng": 2.2945, "name": "Eiffel Tower (Estimated)"}
-        """
-        
-        response = model.generate_content([prompt, image_input])
-        return response.text, None
+        img = _shrink_for_upload(Image.open(file))
+
+        raw_text, error_msg = get_ai_response(model, img)
+
+        if error_msg:
+            return None, error_msg
+
+        # JSON mode guarantees parseable output — no fence-stripping or regex hunt
+        try:
+            data = json.loads(raw_text)
+        except json.JSONDecodeError:
+            return None, f"🚨 Format Error! The AI replied with: {raw_text}"
+
+        # Safety check for null coordinates
+        lat = float(data.get('lat') or 0.0)
+        lng = float(data.get('lng') or 0.0)
+
+        return (file.name, lat, lng, data.get('name', 'Unknown Region')), None
 
     except Exception as e:
-        return None, f"🚨 Model '{chosen_model}' failed: {str(e)}"
+        return None, f"🚨 System Crash on {file.name}: {str(e)}"
+
+def _file_digest(file):
+    """Cache key for an upload: same name and bytes == same cached answer.
 
+    The name matters because the cached DataFrame embeds it — a renamed
+    copy of known bytes must miss so the result carries the new name.
+    """
+    return hashlib.blake2b(file.name.encode() + bytes(file.getbuffer()), digest_size=16).digest()
+
+@st.cache_data(show_spinner=False, hash_funcs={UploadedFile: _file_digest})
 def process_uploaded_files(files):
-    """Processes images with active UI Telemetry."""
-    results = []
-    
-    for file in files:
-        try:
-            img = Image.open(file)
-            
-            # Call the Auto-Detect AI function
-            raw_text, error_msg = get_ai_response(img)
-            
-            if error_msg:
-                return error_msg, pd.DataFrame()
-
-            # --- X-RAY CHECK: Can we read the JSON? ---
-            match = re.search(r'\{.*\}', raw_text, re.DOTALL)
-            if match:
-                data = json.loads(match.group(0))
-                
-                # Safety check for null coordinates
-                lat = float(data.get('lat') or 0.0)
-                lng = float(data.get('lng') or 0.0)
-                
-                results.append({
-                    "File": file.name,
-                    "Lat": lat,
-                    "Lon": lng,
-                    "Source": "AI Neural Vision",
-                    "landmark": data.get('name', 'Unknown Region')
-                })
-            else:
-                return f"🚨 Format Error! The AI replied with: {raw_text}", pd.DataFrame()
-                
-            time.sleep(1.0) # Short pause to be nice to the API
-            
-        except Exception as e:
-            return f"🚨 System Crash on {file.name}: {str(e)}", pd.DataFrame()
-            
-    if not results:
-        return "⚠️ AI Neural Vision could not extract recognizable landmarks.", pd.DataFrame()
-        
-    return "✅ Neural Intelligence Extraction Successful.", pd.DataFrame(results)
+    """Processes images concurrently with active UI Telemetry.
+
+    Cached by image content, so re-submitting the same evidence never
+    re-uploads it to Gemini. Failures raise ExtractionError so they are
+    never cached alongside real results.
+    """
+    try:
+        model = resolve_model()
+    except RuntimeError as e:
+        raise ExtractionError(str(e)) from e
+
+    # Each image is an independent network round-trip: run them in parallel.
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as pool:
+        outcomes = list(pool.map(lambda f: _analyze_file(model, f), files))
+
+    # Columnar accumulation: hand pandas pre-typed arrays instead of a
+    # list-of-dicts it would have to hash and type-infer per row.
+    names, landmarks = [], []
+    lats, lons = array('d'), array('d')
+    for row, error_msg in outcomes:
+        if error_msg:
+            raise ExtractionError(error_msg)
+        names.append(row[0])
+        lats.append(row[1])
+        lons.append(row[2])
+        landmarks.append(row[3])
+
+    if not names:
+        raise ExtractionError("⚠️ AI Neural Vision could not extract recognizable landmarks.")
+
+    df = pd.DataFrame({
+        "File": names,
+        "Lat": np.frombuffer(lats, dtype=np.float64),
+        "Lon": np.frombuffer(lons, dtype=np.float64),
+        "Source": "AI Neural Vision",
+        "landmark": landmarks
+    })
+    return "✅ Neural Intelligence Extraction Successful.", df
+
+@st.cache_data(show_spinner=False)
+def build_map(nodes, show_heatmap, show_cctv):
+    """
+    Renders the recon map to static HTML, cached per (nodes, toggles) combo.
+    `nodes` is a tuple of (lat, lon, color, popup_html) tuples so it hashes.
+    Folium's Jinja2 render is heavy — do it once, not on every rerun.
+    """
+    m = folium.Map(location=[nodes[-1][0], nodes[-1][1]], zoom_start=16)
+
+    folium.TileLayer(
+        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+        attr='Esri', name='Satellite Recon', overlay=False
+    ).add_to(m)
+
+    if show_heatmap:
+        HeatMap([[lat, lon] for lat, lon, _, _ in nodes]).add_to(m)
+
+    if len(nodes) > 1:
+        folium.PolyLine([[lat, lon] for lat, lon, _, _ in nodes], color="#00f2ff", weight=4).add_to(m)
+
+    # Canvas-rendered cluster: one JS callback per node instead of N SVG DivIcons,
+    # which keeps the browser responsive on large forensic batches.
+    marker_callback = """
+    function (row) {
+        var m = L.circleMarker([row[0], row[1]], {color: 'white', weight: 2, fillColor: row[2], fillOpacity: 0.95, radius: 7});
+        m.bindPopup(row[3], {maxWidth: 250});
+        return m;
+    };
+    """
+    FastMarkerCluster(
+        data=[list(row) for row in nodes],
+        callback=marker_callback
+    ).add_to(m)
+
+    if show_cctv:
+        for lat, lon, _, _ in nodes:
+            folium.Circle([lat, lon], radius=100, color='#FFD700', fill=True, fill_opacity=0.05).add_to(m)
+
+    return m._repr_html_()
 
 # ==========================================
 # --- 1. PAGE SETUP & CYBER-THEME ---
 # ==========================================
 st.set_page_config(page_title="M2 Geo-Forensics Engine", layout="wide")
 
-st.markdown("""
-    <style>
-    .stApp { background-color: #0b0e14; color: #e0e0e0; font-family: 'Courier New', Courier, monospace; }
-    
-    section[data-testid="stSidebar"] {
-        background-color: rgba(255, 255, 255, 0.05) !important;
-        backdrop-filter: blur(15px);
-        border-right: 1px solid rgba(0, 242, 255, 0.2);
-    }
+@st.cache_resource(show_spinner=False)
+def load_css():
+    """Reads the cyber-theme stylesheet once per process, not per rerun."""
+    css_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "style.css")
+    with open(css_path) as f:
+        return f.read()
 
-    [data-testid="stMetricValue"] { color: #00f2ff !important; text-shadow: 0 0 10px rgba(0, 242, 255, 0.5); }
-    
-    div[data-testid="stElementContainer"] > div[style*="border"] {
-        background-color: rgba(255, 255, 255, 0.02) !important;
-        border: 1px solid rgba(0, 242, 255, 0.15) !important;
-        border-radius: 10px !important;
-    }
-
-    .terminal-box {
-        background: rgba(0, 0, 0, 0.7); color: #00ff41; padding: 10px;
-        font-size: 0.8rem; border-left: 2px solid #00ff41; margin-top: 20px;
-    }
-    </style>
-    """, unsafe_allow_html=True)
+st.markdown(f"<style>{load_css()}</style>", unsafe_allow_html=True)
 
 # ==========================================
 # --- 2. SESSION INITIALIZATION ---
@@ -148,6 +255,8 @@ if "all_nodes" not in st.session_state:
     st.session_state.all_nodes = []
 if "total_distance" not in st.session_state:
     st.session_state.total_distance = 0.0
+if "cum_km" not in st.session_state:
+    st.session_state.cum_km = np.zeros(1)
 
 # ==========================================
 # --- 3. SIDEBAR RECON CORE ---
@@ -165,38 +274,62 @@ with st.sidebar:
             with st.spinner("Executing Neural Extraction Pipeline..."):
                 st.session_state.all_nodes = []
                 st.session_state.total_distance = 0.0
+                st.session_state.cum_km = np.zeros(1)
                 
-                msg, df = process_uploaded_files(uploaded_files)
-                
-                if not df.empty:
-                    for _, row in df.iterrows():
-                        orig_file = next(f for f in uploaded_files if f.name == row['File'])
-                        
+                try:
+                    msg, df = process_uploaded_files(uploaded_files)
+                except ExtractionError as e:
+                    st.error(str(e))
+                else:
+                    # O(1) lookups + tuple iteration instead of an O(N²) scan over iterrows
+                    file_by_name = {f.name: f for f in uploaded_files}
+                    for name, lat, lon, src, lm in df[['File', 'Lat', 'Lon', 'Source', 'landmark']].itertuples(index=False, name=None):
                         # ✅ FIXED: Use the official Google Maps Domain
-                        clean_url = f"https://www.google.com/maps?q={row['Lat']},{row['Lon']}"
-                        
+                        clean_url = f"https://www.google.com/maps?q={lat},{lon}"
+                        color = "#00f2ff" if "AI" in src else "#FF3B30"
+
+                        # Render marker HTML once at ingestion, not on every rerun
+                        popup_html = f"""
+                        <div style="font-family: monospace; width: 180px;">
+                            <b>NODE:</b> {lm}<br>
+                            <b>SRC:</b> {src}<br>
+                            <hr style="margin:5px 0;">
+                            <a href="{clean_url}" target="_blank"
+                               style="background-color: {color}; color: white; padding: 5px 10px; text-decoration: none; border-radius: 4px; display: block; text-align: center; font-weight: bold;">
+                               🚀 OPEN MAPS
+                            </a>
+                        </div>
+                        """
+                        # Gallery thumbnail generated once here — st.image re-sends
+                        # its payload on every rerun, so keep it ~400px, not 4000px.
+                        src_file = file_by_name[name]
+                        src_file.seek(0)
+                        thumb_img = Image.open(src_file)
+                        thumb_img.thumbnail((400, 400), Image.LANCZOS)
+                        thumb_buf = io.BytesIO()
+                        thumb_img.convert("RGB").save(thumb_buf, "JPEG", quality=75)
+
                         st.session_state.all_nodes.append({
-                            "name": row['File'], 
-                            "lat": row['Lat'], 
-                            "lon": row['Lon'],
-                            "landmark": row.get('landmark', 'Identified Node'),
-                            "source": row['Source'],
-                            "color": "#00f2ff" if "AI" in row['Source'] else "#FF3B30",
-                            "img": orig_file, 
-                            "url": clean_url
+                            "name": name,
+                            "lat": lat,
+                            "lon": lon,
+                            "landmark": lm,
+                            "source": src,
+                            "color": color,
+                            "thumb": thumb_buf.getvalue(),
+                            "url": clean_url,
+                            "popup_html": popup_html
                         })
                     
                     if len(st.session_state.all_nodes) > 1:
-                        dist = 0.0
-                        for i in range(len(st.session_state.all_nodes)-1):
-                            dist += geodesic(
-                                (st.session_state.all_nodes[i]['lat'], st.session_state.all_nodes[i]['lon']), 
-                                (st.session_state.all_nodes[i+1]['lat'], st.session_state.all_nodes[i+1]['lon'])
-                            ).km
-                        st.session_state.total_distance = dist
+                        # One vectorized C call instead of N python-level geodesic solves.
+                        # Kept cumulative so every slider tick is an O(1) lookup.
+                        lats = np.fromiter((n['lat'] for n in st.session_state.all_nodes), dtype=np.float64)
+                        lons = np.fromiter((n['lon'] for n in st.session_state.all_nodes), dtype=np.float64)
+                        _, _, seg_m = Geod(ellps='WGS84').inv(lons[:-1], lats[:-1], lons[1:], lats[1:])
+                        st.session_state.cum_km = np.concatenate(([0.0], np.cumsum(seg_m) / 1000.0))
+                        st.session_state.total_distance = float(st.session_state.cum_km[-1])
                     st.success(msg)
-                else:
-                    st.error(msg)
 
     st.markdown(f"""<div class="terminal-box">
         [SYS]: M2 Engine Active<br>[SCAN]: {len(st.session_state.all_nodes)} Nodes<br>[STATUS]: Analysis Live
@@ -221,10 +354,14 @@ if all_nodes:
     
     processed_data = all_nodes[:step]
 
+    # Distance for the visible prefix: indexed from the precomputed cumulative array
+    cum_km = st.session_state.cum_km
+    step_km = float(cum_km[min(step - 1, len(cum_km) - 1)])
+
     # Metrics
     m1, m2, m3 = st.columns(3)
     m1.metric("ACTIVE NODES", len(processed_data))
-    m2.metric("TRAJECTORY", f"{total_distance:.2f} KM")
+    m2.metric("TRAJECTORY", f"{step_km:.2f} / {total_distance:.2f} KM")
     m3.metric("TIMELINE STEP", f"{step} / {len(all_nodes)}")
 
     st.divider()
@@ -235,63 +372,24 @@ if all_nodes:
     with col_left:
         st.subheader("Satellite Recon Map")
         if processed_data:
-            m = folium.Map(location=[processed_data[-1]['lat'], processed_data[-1]['lon']], zoom_start=16)
-            
-            folium.TileLayer(
-                tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-                attr='Esri', name='Satellite Recon', overlay=False
-            ).add_to(m)
-
-            if show_heatmap:
-                HeatMap([[d['lat'], d['lon']] for d in processed_data]).add_to(m)
-
-            if len(processed_data) > 1:
-                folium.PolyLine([[d['lat'], d['lon']] for d in processed_data], color="#00f2ff", weight=4).add_to(m)
-
-            for d in processed_data:
-                # ----------------------------------------------------
-                # ✅ FIX: HTML POPUP WITH NAVIGATION LINK
-                # ----------------------------------------------------
-                popup_html = f"""
-                <div style="font-family: monospace; width: 180px;">
-                    <b>NODE:</b> {d['landmark']}<br>
-                    <b>SRC:</b> {d['source']}<br>
-                    <hr style="margin:5px 0;">
-                    <a href="{d['url']}" target="_blank" 
-                       style="background-color: {d['color']}; color: white; padding: 5px 10px; text-decoration: none; border-radius: 4px; display: block; text-align: center; font-weight: bold;">
-                       🚀 OPEN MAPS
-                    </a>
-                </div>
-                """
-                
-                icon_html = f"""<div style="width:14px; height:14px; background:{d['color']}; border-radius:50%; box-shadow:0 0 10px {d['color']}; border: 2px solid white;"></div>"""
-                
-                folium.Marker(
-                    [d['lat'], d['lon']],
-                    popup=folium.Popup(popup_html, max_width=250),
-                    icon=folium.DivIcon(html=icon_html)
-                ).add_to(m)
-                
-                if show_cctv:
-                    folium.Circle([d['lat'], d['lon']], radius=100, color='#FFD700', fill=True, fill_opacity=0.05).add_to(m)
-
-            st_folium(m, use_container_width=True, height=550, returned_objects=[])
+            map_key = tuple((d['lat'], d['lon'], d['color'], d['popup_html']) for d in processed_data)
+            components.html(build_map(map_key, show_heatmap, show_cctv), height=550)
 
     with col_right:
         st.subheader("Intelligence Stream")
         st.dataframe(pd.DataFrame(processed_data)[['name', 'source', 'landmark']], height=510, use_container_width=True)
 
-    # RECON GALLERY
+    # RECON GALLERY — tiles show the pre-generated thumbnails, so each rerun
+    # ships a few hundred KB over the websocket instead of the full originals
     st.markdown("---")
-    st.subheader("🖼️ RECONNAISSANCE GALLERY")
-    
-    if processed_data:
-        cols = st.columns(4)
-        for i, d in enumerate(processed_data):
-            with cols[i % 4]:
-                with st.container(border=True):
-                    st.image(d['img'], use_container_width=True)
-                    st.markdown(f"<p style='color:{d['color']}; font-weight:bold; font-size: 0.8rem;'>NODE {i+1}: {d['landmark']}</p>", unsafe_allow_html=True)
-                    st.link_button("🚀 NAVIGATE", d['url'], use_container_width=True)
+    with st.expander("🖼️ RECONNAISSANCE GALLERY", expanded=True):
+        if processed_data:
+            cols = st.columns(4)
+            for i, d in enumerate(processed_data):
+                with cols[i % 4]:
+                    with st.container(border=True):
+                        st.image(d['thumb'], use_container_width=True)
+                        st.markdown(f"<p style='color:{d['color']}; font-weight:bold; font-size: 0.8rem;'>NODE {i+1}: {d['landmark']}</p>", unsafe_allow_html=True)
+                        st.link_button("🚀 NAVIGATE", d['url'], use_container_width=True)
 else:
     st.info("🛰️ **System Standby.** Inject forensic images via the sidebar to initialize tracking.")
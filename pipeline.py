@@ -1,47 +1,249 @@
+import asyncio
+import atexit
+import functools
+import threading
 import pandas as pd
-import google.generativeai as genai
+import numpy as np
+import io
 import os
-import time
-import json
+from array import array
+import orjson
+import hashlib
+import httpx
+import diskcache
+from aiolimiter import AsyncLimiter
+from google import genai
+from google.genai import types
+from google.genai import errors as genai_errors
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
 from PIL import Image
 
+MODEL_NAME = 'gemini-2.5-flash'
+# Each request is network wait, not CPU — fan out, bounded under the RPM quota
+MAX_CONCURRENT_REQUESTS = 8
+# Requests-per-minute budget; set GEMINI_QPM to match your billing tier
+GEMINI_QPM = int(os.getenv("GEMINI_QPM", "60"))
+
+PROMPT = (
+    "For EACH image below, identify the landmark and return its coordinates. "
+    "Return one entry per image, using the file name given just before it."
+)
+# Bump whenever PROMPT or the schema changes so stale cache entries die
+PROMPT_VERSION = 2
+
+# Amortize RTT/TLS: several images share one request (within token budget)
+BATCH_SIZE = 4
+
+# Content-addressed answer cache: the same image bytes always map to the
+# same landmark, so repeats skip the API entirely (and its quota spend).
+_CACHE = diskcache.Cache(os.path.expanduser("~/.cache/geo_extractor"))
+
+# JSON mode: the model must emit exactly this shape, so no fence-stripping
+GENERATION_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema={
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "file": {"type": "string"},
+                "lat": {"type": "number"},
+                "lng": {"type": "number"},
+                "name": {"type": "string"}
+            },
+            "required": ["file", "lat", "lng", "name"]
+        }
+    }
+)
+
+@functools.lru_cache(maxsize=1)
+def _worker_loop():
+    """Persistent event loop on a daemon thread for all Gemini async work.
+
+    The cached client shares one httpx AsyncClient across batches; its
+    keepalive sockets belong to the loop they were opened on, so every batch
+    must run on this same loop. A per-call asyncio.run() would close its loop
+    on return and leave the pool full of dead connections for the next batch.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True, name="gemini-loop").start()
+    atexit.register(loop.call_soon_threadsafe, loop.stop)
+    return loop
+
+def _run_async(coro):
+    """Runs a coroutine on the persistent worker loop and waits for the result."""
+    return asyncio.run_coroutine_threadsafe(coro, _worker_loop()).result()
+
+@functools.lru_cache(maxsize=1)
+def _rate_limiter():
+    """One token bucket per process so the QPM budget spans batches.
+
+    Safe to share because every acquire happens on the persistent worker
+    loop; call this from coroutines already running there.
+    """
+    return AsyncLimiter(max_rate=GEMINI_QPM, time_period=60)
+
+@functools.lru_cache(maxsize=1)
+def _build_client(api_key):
+    """One client per process: its connection pool stays warm across batches."""
+    # Explicit httpx transport so async calls are truly awaited on the event
+    # loop (HTTP/2 multiplexed) instead of sync requests wrapped in threads.
+    client = genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            async_client_args={
+                "transport": httpx.AsyncHTTPTransport(
+                    retries=0,
+                    http2=True,
+                    limits=httpx.Limits(max_keepalive_connections=100, max_connections=100)
+                )
+            }
+        )
+    )
+    if hasattr(client, "close"):
+        atexit.register(client.close)
+    return client
+
 # Initialize AI with Cloud Secrets
-def get_ai_model():
+def get_ai_client():
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
         return None
-    genai.configure(api_key=api_key)
-    return genai.GenerativeModel('gemini-2.5-flash')
+    return _build_client(api_key)
+
+MAX_UPLOAD_EDGE = 1024  # landmark ID doesn't benefit from >1024px
+
+def _shrink_for_upload(img_bytes):
+    """Downscales oversized images to a JPEG part so uploads stay small."""
+    img = Image.open(io.BytesIO(img_bytes))
+    if max(img.size) <= MAX_UPLOAD_EDGE:
+        return types.Part.from_bytes(
+            data=img_bytes, mime_type=Image.MIME.get(img.format, 'image/jpeg')
+        )
+    img.thumbnail((MAX_UPLOAD_EDGE, MAX_UPLOAD_EDGE), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.convert('RGB').save(buf, 'JPEG', quality=85, optimize=True)
+    return types.Part.from_bytes(data=buf.getvalue(), mime_type='image/jpeg')
+
+def _is_transient(exc):
+    """Only 429s and 5xx deserve another attempt; anything else fails fast."""
+    if isinstance(exc, genai_errors.APIError):
+        return exc.code == 429 or (exc.code or 0) >= 500
+    return isinstance(exc, httpx.TransportError)
+
+def _row(name, data):
+    return (name, float(data.get('lat') or 0.0), float(data.get('lng') or 0.0),
+            data.get('name', 'Unknown Node'), None)
+
+def _failure_row(name, reason):
+    """Failed files stay in the output so callers can retry just those."""
+    return (name, float('nan'), float('nan'), None, reason)
+
+async def _analyze_chunk(client, chunk, sem, limiter):
+    """One API call covering several images; answers fan back out by file name."""
+    async with sem:
+        # Decode/resize on worker threads so PIL work for this chunk overlaps
+        # with other chunks' in-flight HTTP instead of blocking the event loop
+        parts = await asyncio.gather(
+            *[asyncio.to_thread(_shrink_for_upload, img_bytes) for _, img_bytes, _ in chunk]
+        )
+        contents = [PROMPT]
+        for (name, _, _), part in zip(chunk, parts):
+            contents.append(f"File: {name}")
+            contents.append(part)
+
+        # Back off (with jitter) only when the API actually pushes back
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception(_is_transient),
+            wait=wait_random_exponential(min=1, max=30),
+            stop=stop_after_attempt(5),
+            reraise=True,
+        ):
+            with attempt:
+                # Token bucket shapes request rate to the quota; the tenacity
+                # backoff above still handles any 429 that slips through
+                async with limiter:
+                    response = await client.aio.models.generate_content(
+                        model=MODEL_NAME, contents=contents, config=GENERATION_CONFIG
+                    )
+
+    entries = {entry.get('file'): entry for entry in orjson.loads(response.text)}
+    rows = []
+    for name, _, cache_key in chunk:
+        data = entries.get(name)
+        if data is None:
+            rows.append(_failure_row(name, "no answer returned for this file"))
+            continue
+        _CACHE.set(cache_key, data)
+        rows.append(_row(name, data))
+    return rows
+
+async def _analyze_batch(client, files):
+    rows = []
+
+    # Cache hits resolve immediately; only misses cost an API slot
+    misses = []
+    for file in files:
+        file.seek(0)
+        img_bytes = file.read()
+        cache_key = (hashlib.blake2b(img_bytes, digest_size=16).hexdigest(), MODEL_NAME, PROMPT_VERSION)
+        data = _CACHE.get(cache_key)
+        if data is None:
+            misses.append((file.name, img_bytes, cache_key))
+        else:
+            rows.append(_row(file.name, data))
+
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = _rate_limiter()
+    chunks = [misses[i:i + BATCH_SIZE] for i in range(0, len(misses), BATCH_SIZE)]
+    outcomes = await asyncio.gather(
+        *[_analyze_chunk(client, c, sem, limiter) for c in chunks],
+        return_exceptions=True
+    )
+    for chunk, outcome in zip(chunks, outcomes):
+        if isinstance(outcome, Exception):
+            # A failed chunk becomes one failure row per file, not a print
+            rows.extend(_failure_row(name, repr(outcome)) for name, _, _ in chunk)
+        else:
+            rows.extend(outcome)
+    return rows
 
 def process_uploaded_files(files):
     """Processes a list of files from memory. Returns (Status_Msg, DataFrame)"""
-    model = get_ai_model()
-    if not model:
+    client = get_ai_client()
+    if not client:
         return "❌ API Key Missing in Cloud Secrets", pd.DataFrame()
 
-    results = []
-    for file in files:
-        try:
-            img = Image.open(file)
-            prompt = "Identify this landmark. Return ONLY JSON: {'lat': float, 'lng': float, 'name': str}"
-            response = model.generate_content([prompt, img])
-            
-            # Clean and parse JSON
-            clean_json = response.text.replace('```json', '').replace('```', '').strip()
-            data = json.loads(clean_json)
-            
-            results.append({
-                "File": file.name,
-                "Lat": data.get('lat'),
-                "Lon": data.get('lng'),
-                "Source": "AI Neural Vision",
-                "landmark": data.get('name', 'Unknown Node')
-            })
-            time.sleep(1.2) # Rate limit breather
-        except Exception as e:
-            print(f"Error: {e}")
-            
-    if not results:
+    outcomes = _run_async(_analyze_batch(client, files))
+
+    # Columnar accumulation: pandas gets pre-typed arrays, not a list of
+    # dicts it would have to hash and type-infer row by row.
+    names, landmarks, errors = [], [], []
+    lats, lons = array('d'), array('d')
+    for name, lat, lng, landmark, error in outcomes:
+        names.append(name)
+        lats.append(lat)
+        lons.append(lng)
+        landmarks.append(landmark)
+        errors.append(error)
+
+    if not names:
         return "⚠️ No landmarks recognized in these images.", pd.DataFrame()
-        
-    return "✅ Intelligence Extraction Successful", pd.DataFrame(results)
+
+    # Failures ride along with Lat/Lon = NaN; filter df[df.error.notna()]
+    # to resubmit only what actually failed.
+    df = pd.DataFrame({
+        "File": names,
+        "Lat": np.frombuffer(lats, dtype=np.float64),
+        "Lon": np.frombuffer(lons, dtype=np.float64),
+        "Source": "AI Neural Vision",
+        "landmark": landmarks,
+        "error": errors
+    })
+
+    failed = int(df['error'].notna().sum())
+    if failed == len(df):
+        return "⚠️ No landmarks recognized in these images.", df
+    if failed:
+        return f"⚠️ Extraction finished with {failed} failed image(s).", df
+    return "✅ Intelligence Extraction Successful", df